@@ -2,8 +2,11 @@
 
 import re
 import sys
-import fileinput
+import bisect
+import string
+import pathlib
 import operator
+import itertools
 
 
 class Symbol(object):
@@ -17,13 +20,18 @@ class Symbol(object):
                  'm': 'method',
                  'M': 'method'}
 
+    __slots__ = ('name', 'filename', 'line', 'lineno', 'kind', 'scope', 'parent',
+                 '_qualified_name')
+
     def __init__(self, name, filename, line, kind, lineno, parent):
         self.name = name
         self.filename = filename
         self.line = line
         self.lineno = lineno
-        self._kind = kind
+        self.kind = self.KIND_MAP[kind]
+        self.scope = self.SCOPE_MAP[kind]
         self.parent = parent
+        self._qualified_name = None
 
     def to_tags_line(self):
         '''Format this simple for use in ``tags``.
@@ -34,47 +42,25 @@ class Symbol(object):
 
         .. _tags: http://vimdoc.sourceforge.net/htmldoc/tagsrch.html#tags-file-format.
         '''
-        res = '{0.name}\t{0.filename}\t/^{0.line}$/;"\t{0.kind}\tline:{0.lineno}'.format(self)
-        parent = self.get_named_parent()
+        res = f'{self.name}\t{self.filename}\t/^{self.line}$/;"\t{self.kind}\tline:{self.lineno}'
+        parent = self.parent
         if parent:
-            res += '\t{0.scope}:{0.qualified_name}'.format(parent)
+            res += f'\t{parent.scope}:{parent.qualified_name}'
         return res
 
     @property
     def qualified_name(self):
         '''Get the qualified name (i.e. including the name of all ancestors).
 
-        The qualified name is in the form ``A,B,C``.
-        '''
-        name_parts = []
-        cur = self
-        while cur:
-            name = cur.name
-            if name:
-                name_parts.append(name)
-            cur = cur.parent
-
-        return ','.join(reversed(name_parts))
-
-    @property
-    def scope(self):
-        return self.SCOPE_MAP[self._kind]
-
-    @property
-    def kind(self):
-        return self.KIND_MAP[self._kind]
-
-    def get_named_parent(self):
-        '''Get the nearest ancestor which has a valid name.
-
-        If there are no ancestors having names, this method returns None.
+        The qualified name is in the form ``A,B,C``. It is computed from the
+        parent's (cached) qualified name on first access.
         '''
-        cur = self.parent
-        while cur:
-            if cur.name:
-                return cur
+        if self._qualified_name is None:
+            if self.parent:
+                self._qualified_name = self.parent.qualified_name + ',' + self.name
             else:
-                cur = cur.parent
+                self._qualified_name = self.name
+        return self._qualified_name
 
 
 class SimpleOzParser(object):
@@ -102,32 +88,57 @@ class SimpleOzParser(object):
     #   $
     #
 
+    NUM_TOKENS = 11
     (IGNORE, CLASS, PROC, METH, END, BRACE, EXCL, DOLLAR, SCOPE, ATOM, VAR) \
-            = range(11)
+            = range(NUM_TOKENS)
 
     LEXER_PATTERNS = [
-        (re.compile(r'class\b'), CLASS),
-        (re.compile(r'(?:fun|proc)\b'), PROC),
-        (re.compile(r'meth\b'), METH),
-        (re.compile(r'end\b'), END),
-        (re.compile(r'\{'), BRACE),
-        (re.compile(r'!(?!!)'), EXCL),
-        (re.compile(r'\$'), DOLLAR),
-        (re.compile(r'''(?:
-            # standard scope starters.
-                local|if|case|lock|thread|try|raise|
-            # constraint programming
-                not|cond|or|dis|choice|
-            # others
-                functor|for)\b''', re.X), SCOPE),
-        (re.compile(r"[a-z]\w*|'(?:[^\\']|\\.)*'"), ATOM),
-        (re.compile(r'[A-Z]\w*|`(?:[^\\`]|\\.)*`'), VAR),
-        (re.compile(r'/\*(?:[^*]|\*[^/])*\*/'), IGNORE),
-        (re.compile(r'%.*'), IGNORE),
-        (re.compile(r'&(?:[^\\]|\\(?:[xX][0-9a-fA-F]{2}|[^xX]))'), IGNORE),
-        (re.compile(r'''/(?!\*)|[^a-zA-Z'`"%/&{!$]+'''), IGNORE)
+        (r'!(?!!)', EXCL),
+        (r"[a-z]\w*|'(?:[^\\']|\\.)*'", ATOM),
+        (r'[A-Z]\w*|`(?:[^\\`]|\\.)*`', VAR),
+        (r'/\*(?:[^*]|\*[^/])*\*/', IGNORE),
+        (r'%.*', IGNORE),
+        (r'&(?:[^\\]|\\(?:[xX][0-9a-fA-F]{2}|[^xX]))', IGNORE),
+        (r'/(?!\*)', IGNORE)
     ]
 
+    # All patterns are fused into a single alternation so that one call to
+    # ``match`` picks the winning pattern. Each pattern gets its own named
+    # group, which is mapped back to the token type via ``lastgroup``.
+    LEXER_RE = re.compile('|'.join(f'(?P<g{i}>{pattern})'
+                                   for i, (pattern, _) in enumerate(LEXER_PATTERNS)))
+    LEXER_GROUP_TOKENS = {f'g{i}': token_type
+                          for i, (_, token_type) in enumerate(LEXER_PATTERNS)}
+
+    # Characters which can start a token. Everything else is skipped in bulk:
+    # the buffer is translated so that only significant characters become
+    # "\x01", and the next token is then located with ``str.find``.
+    SIGNIFICANT_CHARS = string.ascii_letters + '\'`"%/&{!$'
+    SIGNIFICANT_MARKS = dict.fromkeys(map(ord, SIGNIFICANT_CHARS), '\x01')
+    SIGNIFICANT_MARKS[ord('\x01')] = '\x00'
+
+    # Single-character tokens, indexed by the code point of the character, are
+    # dispatched without entering the regex engine.
+    FIRST_CHAR_TOKENS = [None] * 128
+    FIRST_CHAR_TOKENS[ord('{')] = BRACE
+    FIRST_CHAR_TOKENS[ord('$')] = DOLLAR
+
+    # Keywords are lexed as atoms, then picked out by a dictionary lookup.
+    SCOPE_KEYWORDS = frozenset([
+        # standard scope starters.
+        'local', 'if', 'case', 'lock', 'thread', 'try', 'raise',
+        # constraint programming
+        'not', 'cond', 'or', 'dis', 'choice',
+        # others
+        'functor', 'for',
+    ])
+    KEYWORD_TOKENS = dict.fromkeys(SCOPE_KEYWORDS, SCOPE)
+    KEYWORD_TOKENS.update({'class': CLASS,
+                           'fun': PROC,
+                           'proc': PROC,
+                           'meth': METH,
+                           'end': END})
+
     # The "parser" should recognize:
     #
     #   fun Atom? "{" Variable    -> start of function
@@ -141,118 +152,204 @@ class SimpleOzParser(object):
     #   ScopeStart              -> start of anonymous scope
     #
 
-    (ST_INIT, ST_PROC_1, ST_PROC_2, ST_CLASS_1, ST_METH_1) = range(5)
-    CS_PROC = 'f'
-    CS_CLASS = 'c'
-    CS_PUB_METH = 'm'
-    CS_PRIV_METH = 'M'
-    CS_SCOPE = 's'
-    CS_END = 'e'
-
-    PARSER_TRANS_TABLE = [
-        # ST_INIT
-        {PROC: ST_PROC_1, CLASS: ST_CLASS_1, METH: ST_METH_1,
-         END: CS_END, SCOPE: CS_SCOPE},
-        # ST_PROC_1
-        {ATOM: ST_PROC_1, BRACE: ST_PROC_2},
-        # ST_PROC_2
-        {DOLLAR: CS_SCOPE, VAR: CS_PROC},
-        # ST_CLASS_1
-        {VAR: CS_CLASS},
-        # ST_METH_1
-        {EXCL: ST_METH_1, ATOM: CS_PUB_METH, VAR: CS_PRIV_METH},
-    ]
+    # ST_* are intermediate states; CS_* are final states which trigger an
+    # action (see PARSER_ACTIONS) and then go back to ST_INIT.
+    NUM_STATES = 11
+    (ST_INIT, ST_PROC_1, ST_PROC_2, ST_CLASS_1, ST_METH_1,
+     CS_PROC, CS_CLASS, CS_PUB_METH, CS_PRIV_METH, CS_SCOPE, CS_END) \
+            = range(NUM_STATES)
+
+    # The Symbol kind created by each final state.
+    SYMBOL_KINDS = {CS_PROC: 'f',
+                    CS_CLASS: 'c',
+                    CS_PUB_METH: 'm',
+                    CS_PRIV_METH: 'M'}
+
+    # PARSER_TRANS_TABLE[state][token_type] gives the next state. Tokens not
+    # listed for a state go back to ST_INIT. Only ST_* states have a row.
+    NUM_ST_STATES = ST_METH_1 + 1
+    # a class-body comprehension only sees class names in its outermost
+    # iterable, hence copying the rows instead of `[... for _ in range(...)]`.
+    PARSER_TRANS_TABLE = [list(row) for row in [[ST_INIT] * NUM_TOKENS] * NUM_ST_STATES]
+    # ST_INIT
+    PARSER_TRANS_TABLE[ST_INIT][PROC] = ST_PROC_1
+    PARSER_TRANS_TABLE[ST_INIT][CLASS] = ST_CLASS_1
+    PARSER_TRANS_TABLE[ST_INIT][METH] = ST_METH_1
+    PARSER_TRANS_TABLE[ST_INIT][END] = CS_END
+    PARSER_TRANS_TABLE[ST_INIT][SCOPE] = CS_SCOPE
+    # ST_PROC_1
+    PARSER_TRANS_TABLE[ST_PROC_1][ATOM] = ST_PROC_1
+    PARSER_TRANS_TABLE[ST_PROC_1][BRACE] = ST_PROC_2
+    # ST_PROC_2
+    PARSER_TRANS_TABLE[ST_PROC_2][DOLLAR] = CS_SCOPE
+    PARSER_TRANS_TABLE[ST_PROC_2][VAR] = CS_PROC
+    # ST_CLASS_1
+    PARSER_TRANS_TABLE[ST_CLASS_1][VAR] = CS_CLASS
+    # ST_METH_1
+    PARSER_TRANS_TABLE[ST_METH_1][EXCL] = ST_METH_1
+    PARSER_TRANS_TABLE[ST_METH_1][ATOM] = CS_PUB_METH
+    PARSER_TRANS_TABLE[ST_METH_1][VAR] = CS_PRIV_METH
 
     def __init__(self):
-        self._lexer = self._lex()
-        self._parser = self._parse()
-        next(self._lexer)
-        next(self._parser)
-
-    @classmethod
-    def _lex(cls):
-        '''A coroutine to lex strings.'''
-        current_buffer = ""
-
-        # outer loop to keep populating the buffer.
+        # the innermost named scope (None at the top level), and for every open
+        # scope, whether it is named. anonymous scopes only need to be counted
+        # so that `end` can be matched, so no Symbol is created for them.
+        self._cur_scope = None
+        self._scope_stack = []
+        self._cur_name = None
+        self._cur_state = self.ST_INIT
+        self._cur_filename = None
+        self._cur_lines = None
+        self._cur_line_starts = None
+
+    def _lex(self, text):
+        '''Lex a whole file, returning a list of
+        ``(token_type, token_content, position)``.
+
+        Lexing stops at input which cannot be tokenized (e.g. unfinished
+        quotes).
+        '''
+        pos = 0
+        tokens = []
+        find = text.translate(self.SIGNIFICANT_MARKS).find
+
+        # bind everything used per token to locals to avoid attribute lookups.
+        match = self.LEXER_RE.match
+        group_tokens = self.LEXER_GROUP_TOKENS
+        first_char_tokens = self.FIRST_CHAR_TOKENS
+        keyword_tokens = self.KEYWORD_TOKENS
+        ATOM = self.ATOM
+        append = tokens.append
+
+        # Rather than slicing off every token, we advance `pos`.
         while True:
-            current_buffer += yield
-
-            # inner loop to consume the buffer.
-            while current_buffer:
-                #print(repr(current_buffer))
-                for pattern, token_type in cls.LEXER_PATTERNS:
-                    m = pattern.match(current_buffer)
-                    if m is not None:
-                        match_length = m.end()
-                        if token_type:
-                            token_content = current_buffer[:match_length]
-                            yield (token_type, token_content)
-                        current_buffer = current_buffer[match_length:]
-                        break
-                else:
-                    # if we reach here, none of the patterns match the input,
-                    # likely meaning unfinished quotes. try to populate the
-                    # buffer.
-                    yield
-                    break
-
-    @classmethod
-    def _parse(cls):
-        '''A coroutine to parse tokenized data.'''
-        cur_scope = Symbol(None, None, None, None, -1, None)
-        cur_symbol = None
-        cur_name = None
-        cur_state = cls.ST_INIT
+            pos = find('\x01', pos)
+            if pos < 0:
+                break
 
-        while True:
-            ((token_type, token_content), line, lineno, filename) = yield cur_symbol
-            cur_symbol = None
-
-            if token_type in (cls.ATOM, cls.VAR):
-                cur_name = token_content
-
-            trans_table = cls.PARSER_TRANS_TABLE[cur_state]
-            cur_state = trans_table.get(token_type, cls.ST_INIT)
-
-            if cur_state in (cls.CS_PROC, cls.CS_CLASS, cls.CS_PUB_METH, cls.CS_PRIV_METH):
-                cur_symbol = Symbol(cur_name, filename, line, cur_state, lineno, cur_scope)
-                cur_scope = cur_symbol
-            elif cur_state == cls.CS_SCOPE:
-                cur_scope = Symbol(None, None, None, token_content, -1, cur_scope)
-            elif cur_state == cls.CS_END:
-                cur_scope = cur_scope.parent
-            else:
+            char = text[pos]
+            token_type = first_char_tokens[ord(char)]
+            if token_type is not None:
+                append((token_type, char, pos))
+                pos += 1
                 continue
 
-            cur_state = cls.ST_INIT
-
-    def feed(self, line, lineno, filename):
-        '''Feed a line into the parser.'''
-        the_input = line
-        while True:
-            res = self._lexer.send(the_input)
-            the_input = None
-            if res:
-                yield self._parser.send((res, line, lineno, filename))
-            else:
+            m = match(text, pos)
+            if m is None:
+                # if we reach here, none of the patterns match the input,
+                # likely meaning unfinished quotes.
                 break
 
+            token_type = group_tokens[m.lastgroup]
+            if token_type:
+                token_content = m.group()
+                if token_type == ATOM:
+                    token_type = keyword_tokens.get(token_content, ATOM)
+                append((token_type, token_content, pos))
+            pos = m.end()
+
+        return tokens
+
+    def _handle_symbol(self, cur_state, token_content, pos):
+        if '\n' in self._cur_name:
+            # a quoted name spanning several lines cannot be written into the
+            # tags file. treat it as an anonymous scope so `end` still matches.
+            self._scope_stack.append(False)
+            return None
+
+        lineno = bisect.bisect_right(self._cur_line_starts, pos)
+        # stdin is not read with universal newlines, so drop a trailing "\r"
+        # which would otherwise end up in the search pattern.
+        line = self._cur_lines[lineno - 1].rstrip('\r')
+        cur_symbol = Symbol(self._cur_name, self._cur_filename, line,
+                            self.SYMBOL_KINDS[cur_state], lineno, self._cur_scope)
+        self._cur_scope = cur_symbol
+        self._scope_stack.append(True)
+        return cur_symbol
+
+    def _handle_scope(self, cur_state, token_content, pos):
+        self._scope_stack.append(False)
+
+    def _handle_end(self, cur_state, token_content, pos):
+        # a stray `end` outside of any scope is ignored.
+        if self._scope_stack and self._scope_stack.pop():
+            self._cur_scope = self._cur_scope.parent
+
+    # PARSER_ACTIONS[state] is the action run when the parser enters `state`,
+    # or None for intermediate states.
+    PARSER_ACTIONS = [None] * NUM_STATES
+    PARSER_ACTIONS[CS_PROC] = _handle_symbol
+    PARSER_ACTIONS[CS_CLASS] = _handle_symbol
+    PARSER_ACTIONS[CS_PUB_METH] = _handle_symbol
+    PARSER_ACTIONS[CS_PRIV_METH] = _handle_symbol
+    PARSER_ACTIONS[CS_SCOPE] = _handle_scope
+    PARSER_ACTIONS[CS_END] = _handle_end
+
+    def _step(self, token_type, token_content, pos):
+        '''Advance the parser by one token.
+
+        Returns the new symbol if the token completes one, otherwise None.
+        '''
+        if token_type in (self.ATOM, self.VAR):
+            self._cur_name = token_content
 
-parser = SimpleOzParser()
-all_symbols = []
+        cur_state = self.PARSER_TRANS_TABLE[self._cur_state][token_type]
+        action = self.PARSER_ACTIONS[cur_state]
+        if action is None:
+            self._cur_state = cur_state
+            return None
 
-for line in fileinput.input():
-    filename = fileinput.filename()
-    line = line.rstrip('\r\n')
-    lineno = fileinput.lineno()
-    symbols = parser.feed(line, lineno, filename)
-    true_symbols = filter(None, symbols)
-    all_symbols.extend(true_symbols)
+        self._cur_state = self.ST_INIT
+        return action(self, cur_state, token_content, pos)
 
-all_symbols.sort(key=operator.attrgetter('name'))
-for symbol in all_symbols:
-    print(symbol.to_tags_line())
+    def feed(self, text, filename):
+        '''Feed the content of a whole file into the parser, yielding the
+        symbols found.
+
+        Each file is parsed from a clean state, so an unclosed scope or an
+        unreadable token in one file does not affect the next.
+        '''
+        self._cur_scope = None
+        self._scope_stack = []
+        self._cur_name = None
+        self._cur_state = self.ST_INIT
+
+        lines = text.split('\n')
+        # line_starts[i] is the position where line i+1 starts.
+        line_starts = [0]
+        line_starts.extend(itertools.accumulate(len(line) + 1 for line in lines[:-1]))
+
+        # the file context only changes here, so keep it on the parser instead
+        # of passing it along with every token.
+        self._cur_filename = filename
+        self._cur_lines = lines
+        self._cur_line_starts = line_starts
+
+        step = self._step
+        for token_type, token_content, pos in self._lex(text):
+            symbol = step(token_type, token_content, pos)
+            if symbol:
+                yield symbol
+
+
+def main():
+    parser = SimpleOzParser()
+    all_symbols = []
+
+    for filename in sys.argv[1:] or ['-']:
+        if filename == '-':
+            filename = '<stdin>'
+            text = sys.stdin.read()
+        else:
+            text = pathlib.Path(filename).read_text()
+        all_symbols.extend((symbol.name, symbol) for symbol in parser.feed(text, filename))
+
+    all_symbols.sort(key=operator.itemgetter(0))
+    sys.stdout.write(''.join(symbol.to_tags_line() + '\n' for _, symbol in all_symbols))
+
+
+if __name__ == '__main__':
+    main()
 
 
 # oztags.py -- Create tags for Oz source.